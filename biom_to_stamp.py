@@ -11,11 +11,27 @@ __email__ = "morgan.g.i.langille@gmail.com"
 __status__ = "Development"
 
 import argparse
-from os.path import join
+from os import makedirs
+from os.path import basename, exists, join
+from multiprocessing import Pool
 import sys
 import re
+from itertools import chain
+from functools import lru_cache
 #Requires BIOM v2.1
-from biom import load_table
+from biom import load_table, Table
+from biom.table import general_parser, vlen_list_of_str_parser
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def level_list(levels):
+    """Parse comma-separated levels (e.g. "2,3,6") for --collapse_level."""
+    try:
+        return [int(level) for level in levels.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma-separated integers, got '"+levels+"'")
 
 
 parser = argparse.ArgumentParser(description="Convert a BIOM table to a compatible STAMP profile table. Metadata will be parsed and used as hiearachal data for STAMP.", 
@@ -31,12 +47,49 @@ biom_to_stamp.py -m KEGG_Pathways pathways.biom > pathways.spf
 
 #Don't use any metadata, just the observation ids (useful for looking just at OTU level)
 biom_to_stamp.py otu.biom > otu.spf
+
+#Collapse an OTU table to phylum, class and genus in one pass (writes spf/otu_L2.spf, spf/otu_L3.spf, spf/otu_L6.spf)
+biom_to_stamp.py -m taxonomy --collapse_level 2,3,6 -o spf otu.biom
+
+#Convert many tables at once with 4 worker processes (writes spf/run1.spf, spf/run2.spf, ...)
+biom_to_stamp.py -m taxonomy -p 4 -o spf run1.biom run2.biom run3.biom
+
+#Convert the tables listed in a manifest (one BIOM file per line, optionally followed by a tab and its metadata field)
+biom_to_stamp.py -m taxonomy -p 4 -o spf --manifest tables.txt
 '''
                                  ,formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument("biom_file",help="input BIOM file")
+parser.add_argument("biom_file",nargs="*",help="input BIOM file(s)")
 
 parser.add_argument("-m","--metadata",help="Name of metadata field to be used (e.g. taxonomy, KEGG_Description, KEGG_Pathways)")
 
+parser.add_argument("--chunk_size",type=int,default=1000,help="Number of observations (rows) formatted and written at a time (default: %(default)s)")
+
+parser.add_argument("--sample_ids",help="File with the ids of the samples to keep, one per line. Other samples are dropped while the table is read")
+
+parser.add_argument("--observation_ids",help="File with the ids of the observations to keep, one per line. Ids not found in the table are ignored. With --stream only the counts and metadata of these rows are read for the output (the metadata of all rows is still parsed once to find the number of levels). Without --stream the whole table is loaded first and the other observations are dropped before their counts are formatted")
+
+parser.add_argument("--metadata_prefix",help="Only keep observations whose (processed) --metadata levels start with these semicolon-separated levels (e.g. 'k__Bacteria;p__Firmicutes'). Every observation has to be read to check its metadata: with --stream the table is read chunk by chunk, without --stream it is loaded first, and in both cases the other observations are dropped before their counts are formatted")
+
+parser.add_argument("--min_total_count",type=float,help="Drop observations whose counts sum (across the kept samples) to less than this value")
+
+parser.add_argument("--min_rel_abundance",type=float,help="Drop observations whose counts make up less than this fraction of all counts in the table (e.g. 0.0001)")
+
+parser.add_argument("--min_prevalence",type=float,help="Drop observations that are non-zero in less than this fraction of samples (e.g. 0.1)")
+
+parser.add_argument("--collapse_level",type=level_list,help="Sum the counts of observations sharing the same first N levels of their (processed) --metadata (e.g. 6 for genus with a 7-level taxonomy) and output one row per group. Several comma-separated levels (e.g. 2,3,6) can be given to write one SPF per level (named e.g. otu_L2.spf, otu_L6.spf in --output_dir) from a single pass over the table")
+
+parser.add_argument("--count_format",choices=["shortest","auto","int","fixed"],default="shortest",help="How counts are written: 'shortest' round-trip representation (e.g. 12.0, 0.25), 'int' rounded to whole numbers, 'fixed' with --precision decimal places, or 'auto' to write whole numbers as ints if every count in the table is a whole number (default: %(default)s)")
+
+parser.add_argument("--precision",type=int,default=6,help="Number of decimal places used with --count_format fixed (default: %(default)s)")
+
+parser.add_argument("--manifest",help="File listing input BIOM files, one per line. A metadata field can follow each file name after a tab to override --metadata for that file")
+
+parser.add_argument("-o","--output_dir",help="Directory to write one SPF per input BIOM file (required when converting more than one file)")
+
+parser.add_argument("-p","--processes",type=int,default=1,help="Number of worker processes used to convert multiple BIOM files (default: %(default)s)")
+
+parser.add_argument("--stream",action="store_true",help="Read a BIOM v2.1 (HDF5) file directly in slices of --chunk_size observations instead of loading the whole table, so that memory use is bounded by the chunk size rather than the table size")
+
 script_info = {}
 script_info['brief_description'] = "Convert a BIOM table to a compatible STAMP profile table."
 script_info['script_description'] = "Metadata will be parsed and used as hiearachal data for STAMP."
@@ -49,27 +102,45 @@ script_info['script_usage'] = [\
 ("Function table from MG-RAST","","%prog -m ontology table1.biom > table1.spf")
 ]
 
-script_info['output_description']= "Output is written to STDOUT"
+script_info['output_description']= "Output is written to STDOUT, or to one SPF per input file in --output_dir when converting multiple files"
+
+#Metadata categories that BIOM stores as lists of strings (see biom.Table.from_hdf5)
+LIST_METADATA = ['taxonomy', 'Taxonomy', 'KEGG_Pathways', 'collapsed_ids']
 
        
-def process_metadata(metadata,metadata_name,obs_id):
+#Matches ranks without a name (e.g. "g__"), which are output as "Unclassified"
+UNNAMED_RANK = re.compile(r'[a-z]__$')
+
+#Maximum number of distinct lineages kept in the normalization cache
+LINEAGE_CACHE_SIZE = 100000
+
+@lru_cache(maxsize=LINEAGE_CACHE_SIZE)
+def normalize_lineage(lineage,metadata_name):
+    """Normalize a taxonomy or KEGG_Pathways lineage (as a tuple) into STAMP levels.
+
+    Many observations share the same lineage, so results are cached (least recently used
+    lineages are evicted once LINEAGE_CACHE_SIZE is reached)."""
     if metadata_name =='taxonomy':
         fixed_metadata=[]
-        for idx,val in enumerate(metadata):
+        for val in lineage:
             #odd case that sometimes metadata may have leading space
             val=val.lstrip()
-            if(re.match(r'[a-z]__$',val)):
+            if UNNAMED_RANK.match(val):
                 fixed_metadata.append("Unclassified")
             else:
                 fixed_metadata.append(val)
-        return fixed_metadata
+        return tuple(fixed_metadata)
 
     elif metadata_name == 'KEGG_Pathways':
-        if metadata[0]=='Unclassified':
+        if lineage[0]=='Unclassified':
             #Remove "Unclassified" from the first of the levels
-            del metadata[0]
-            metadata.append(metadata[-1]+'_Unclassified')
-        return metadata
+            lineage=lineage[1:]+(lineage[-1]+'_Unclassified',)
+
+    return lineage
+
+def process_metadata(metadata,metadata_name,obs_id):
+    if metadata_name in ('taxonomy','KEGG_Pathways'):
+        return list(normalize_lineage(tuple(metadata),metadata_name))
     elif metadata_name == 'KEGG_Description':
         single_metadata= ' or '.join(metadata)
         single_metadata=obs_id+': '+single_metadata
@@ -77,73 +148,543 @@ def process_metadata(metadata,metadata_name,obs_id):
     else:
         return metadata
 
-def main():
-    args = parser.parse_args()
+def obs_row_labels(obs_id,lineage,metadata_name,max_len_metadata,include_obs_id):
+    """Return the hierarchy levels (STAMP label columns) for a single observation, given its metadata_name lineage."""
+    row=[]
+    if max_len_metadata >0:
+        row=process_metadata(list(lineage),metadata_name,obs_id)
+
+    #Add 'Unclassified' if the metadata doesn't fill each level
+    len_defined_metadata=len(row)
+    if len_defined_metadata < max_len_metadata:
+        for i in range(max_len_metadata - len_defined_metadata):
+            row.append('Unclassified')
+
+    if include_obs_id:
+        #Add the observation id as the last "Level"
+        if obs_id.isdigit():
+            #Need to add something to the id if it a number identfier (e.g. gg OTU ids)
+            row.append('ID'+'_'+obs_id)
+        else:
+            row.append(obs_id)
+
+    return row
+
+def format_values(values,count_format,precision):
+    """Format a 1D array of counts as an array of strings.
+
+    'shortest' gives the shortest round-trip representation (identical to str() on each value),
+    'int' rounds to whole numbers and 'fixed' uses precision decimal places."""
+    if count_format == 'int':
+        values=np.rint(values)
+        if np.all(np.abs(values) < 2**63):
+            return values.astype(np.int64).astype(str)
+        #too large for 64 bit integers
+        return np.char.mod('%.0f',values)
+    elif count_format == 'fixed':
+        return np.char.mod('%.'+str(precision)+'f',values)
+    else:
+        return values.astype(str)
+
+def format_count_block(block,count_format='shortest',precision=6):
+    """Convert a block of rows from a sparse matrix into a 2D array of strings.
+
+    Only the stored (non-zero) values are formatted; every other cell gets the formatted zero."""
+    block=block.tocsr()
+    block.sum_duplicates()
+
+    values=format_values(block.data,count_format,precision)
+    zero=format_values(np.zeros(1,dtype=block.dtype),count_format,precision)
+    counts=np.full(block.shape,zero[0],dtype=np.promote_types(values.dtype,zero.dtype))
+
+    rows=np.repeat(np.arange(block.shape[0]),np.diff(block.indptr))
+    counts[rows,block.indices]=values
+    return counts
+
+def is_integral(values):
+    """Check whether all values in an array are whole numbers."""
+    return bool(np.all(np.floor(values) == values))
+
+def resolve_count_format(count_format,data_chunks):
+    """Resolve the 'auto' count format to 'int' if every stored count (given as an iterable of arrays) is a whole number, otherwise to 'shortest'."""
+    if count_format != 'auto':
+        return count_format
+
+    for values in data_chunks:
+        if not is_integral(values):
+            return 'shortest'
+    return 'int'
+
+def iter_hdf5_data(biom_file,chunk_length):
+    """Yield the stored counts of an HDF5 BIOM file in slices of chunk_length values."""
+    data=biom_file['observation/matrix/data']
+    for start in range(0,len(data),chunk_length):
+        yield data[start:start+chunk_length]
+
+def as_lineage(value):
+    """Return a metadata value as a hashable lineage (tuple of levels), leaving None and plain strings as they are."""
+    if value is None or isinstance(value,str):
+        return value
+    return tuple(value)
+
+def index_lineages(obs_metadata,metadata_name):
+    """Extract the metadata_name column from the observation metadata in a single pass.
+
+    obs_metadata is a sequence with a metadata dict (or None) per observation. Returns the list of
+    distinct lineages (in order of first appearance, None for observations without the field) and an array with the index of each observation's lineage in that list."""
+    lineage_codes={}
+    codes=np.zeros(len(obs_metadata),dtype=np.int32)
+
+    if metadata_name is not None:
+        for i,md in enumerate(obs_metadata):
+            lineage=as_lineage(md[metadata_name]) if md and metadata_name in md else None
+            codes[i]=lineage_codes.setdefault(lineage,len(lineage_codes))
+
+    if not lineage_codes:
+        lineage_codes[None]=0
+
+    return list(lineage_codes),codes
+
+def iter_table_blocks(table,lineages,codes,chunk_size):
+    """Yield (observation ids, lineages, sparse counts) for chunk_size rows at a time of a loaded BIOM table.
+
+    The underlying sparse matrix is pulled out of the table once and each observation's lineage
+    is looked up from the index built by index_lineages."""
+    matrix=table.matrix_data.tocsr()
+    obs_ids=table.ids(axis='observation')
+
+    for start in range(0,len(obs_ids),chunk_size):
+        stop=min(start+chunk_size,len(obs_ids))
+        yield obs_ids[start:stop],[lineages[c] for c in codes[start:stop]],matrix[start:stop]
+
+def hdf5_obs_lineages(biom_file,metadata_name,rows):
+    """Parse the metadata_name lineages of the rows (a slice or an increasing array of row positions) of an HDF5 BIOM file.
+
+    Returns a list of lineages, or of Nones if the field is absent."""
+    dset_name='observation/metadata/'+metadata_name.replace('/','@@SLASH@@') if metadata_name else None
+    if dset_name is None or dset_name not in biom_file:
+        return [None]*(rows.stop-rows.start if isinstance(rows,slice) else len(rows))
+
+    if metadata_name in LIST_METADATA:
+        parse_f=vlen_list_of_str_parser
+    else:
+        parse_f=general_parser
+
+    return [as_lineage(parse_f(val)) for val in biom_file[dset_name][rows]]
+
+def iter_hdf5_blocks(biom_file,metadata_name,chunk_size,sample_idx=None,obs_idx=None):
+    """Yield (observation ids, lineages, sparse counts) for chunk_size rows at a time of an open BIOM v2.1 HDF5 file.
+
+    Only the matching slices of the CSR indptr/indices/data arrays, the observation ids and the
+    metadata_name metadata are read for each chunk, so the full table is never held in memory.
+    If sample_idx is given only those sample columns (in that order) are kept. If obs_idx (increasing
+    row positions, see hdf5_obs_index) is given only those rows are read."""
+    if obs_idx is not None:
+        yield from iter_hdf5_rows(biom_file,metadata_name,chunk_size,obs_idx,sample_idx)
+        return
+
+    obs_ids=biom_file['observation/ids']
+    indptr=biom_file['observation/matrix/indptr']
+    indices=biom_file['observation/matrix/indices']
+    data=biom_file['observation/matrix/data']
+    num_samples=len(biom_file['sample/ids'])
+
+    for start in range(0,len(obs_ids),chunk_size):
+        stop=min(start+chunk_size,len(obs_ids))
+        block_indptr=indptr[start:stop+1]
+        first,last=block_indptr[0],block_indptr[-1]
+        block=csr_matrix((data[first:last],indices[first:last],block_indptr-first),
+                         shape=(stop-start,num_samples))
+        if sample_idx is not None:
+            block=block[:,sample_idx]
+        yield (obs_ids.asstr()[start:stop],hdf5_obs_lineages(biom_file,metadata_name,slice(start,stop)),block)
+
+def iter_hdf5_rows(biom_file,metadata_name,chunk_size,obs_idx,sample_idx=None):
+    """Yield (observation ids, lineages, sparse counts) for the rows at positions obs_idx (increasing) of an open
+    BIOM v2.1 HDF5 file, chunk_size rows at a time.
+
+    Runs of adjacent rows are read with a single slice of the CSR indices/data arrays, and the other rows
+    (and their metadata) are never read. If sample_idx is given only those sample columns are kept."""
+    obs_ids=biom_file['observation/ids']
+    indptr=biom_file['observation/matrix/indptr']
+    indices=biom_file['observation/matrix/indices']
+    data=biom_file['observation/matrix/data']
+    num_samples=len(biom_file['sample/ids'])
+
+    for start in range(0,len(obs_idx),chunk_size):
+        rows=obs_idx[start:start+chunk_size]
+        block_indptr=indptr[rows[0]:rows[-1]+2]
+        row_starts=block_indptr[rows-rows[0]]
+        row_stops=block_indptr[rows-rows[0]+1]
+
+        #split the rows into runs of adjacent rows
+        run_bounds=np.flatnonzero(np.diff(rows) != 1)+1
+        run_firsts=np.concatenate(([0],run_bounds))
+        run_lasts=np.concatenate((run_bounds,[len(rows)]))-1
+        ranges=[(row_starts[first],row_stops[last]) for first,last in zip(run_firsts,run_lasts)]
 
-    file_name = args.biom_file
-    table = load_table(file_name)
+        block_data=np.concatenate([data[first:last] for first,last in ranges])
+        block_indices=np.concatenate([indices[first:last] for first,last in ranges])
+        new_indptr=np.concatenate(([0],np.cumsum(row_stops-row_starts)))
+        block=csr_matrix((block_data,block_indices,new_indptr),shape=(len(rows),num_samples))
+        if sample_idx is not None:
+            block=block[:,sample_idx]
 
-    metadata_name=args.metadata
+        yield (obs_ids.asstr()[rows],hdf5_obs_lineages(biom_file,metadata_name,rows),block)
 
-    #create the list of observation ids
-    obs_ids=table.ids('observation')
+def hdf5_obs_index(biom_file,keep_obs_ids):
+    """Return the (increasing) positions of the keep_obs_ids rows of an open HDF5 BIOM file. Ids not in the file are ignored."""
+    return np.flatnonzero(np.isin(biom_file['observation/ids'].asstr()[:],list(keep_obs_ids)))
 
-    #Determine how many hierarchy levels the metadata contains
+def iter_hdf5_lineages(biom_file,metadata_name,chunk_size):
+    """Yield the lineages of an HDF5 BIOM file one observation at a time, reading chunk_size rows at a time."""
+    num_obs=len(biom_file['observation/ids'])
+    for start in range(0,num_obs,chunk_size):
+        for lineage in hdf5_obs_lineages(biom_file,metadata_name,slice(start,min(start+chunk_size,num_obs))):
+            yield lineage
+
+def read_id_list(file_name):
+    """Read ids from a file with one id per line (blank lines and lines starting with # are skipped)."""
+    with open(file_name) as id_file:
+        return [line.strip() for line in id_file if line.strip() and not line.startswith('#')]
+
+def sample_index(all_sample_ids,keep_sample_ids):
+    """Return the positions of keep_sample_ids among all_sample_ids (in table order), raising an error for missing ids."""
+    missing=set(keep_sample_ids)-set(all_sample_ids)
+    if missing:
+        raise ValueError("The following sample ids could not be found in the BIOM table: "+", ".join(sorted(missing)))
+    return np.flatnonzero(np.isin(all_sample_ids,keep_sample_ids))
+
+def parse_metadata_prefix(metadata_prefix):
+    """Split a semicolon-separated --metadata_prefix into a tuple of levels."""
+    return tuple(level.strip() for level in metadata_prefix.split(';'))
+
+def lineage_has_prefix(lineage,metadata_name,prefix):
+    """Check whether the normalized levels of a lineage start with the prefix levels."""
+    if lineage is None:
+        return False
+    elif isinstance(lineage,tuple):
+        levels=normalize_lineage(lineage,metadata_name)
+    else:
+        levels=(lineage,)
+    return levels[:len(prefix)] == prefix
+
+def subset_blocks(blocks,metadata_name,keep_obs_ids=None,prefix=None,drop_empty=False):
+    """Drop observations that are not in keep_obs_ids or whose lineage does not start with prefix from each block.
+
+    If drop_empty is set, observations without any non-zero count are dropped as well (as BIOM does
+    after subsetting samples). Excluded rows are removed before the counts are formatted."""
+    if keep_obs_ids is not None:
+        keep_obs_ids=set(keep_obs_ids)
+
+    for obs_ids,lineages,block in blocks:
+        keep=np.ones(len(obs_ids),dtype=bool)
+        if keep_obs_ids is not None:
+            keep&=np.array([obs_id in keep_obs_ids for obs_id in obs_ids],dtype=bool)
+        if prefix:
+            keep&=np.array([lineage_has_prefix(lineage,metadata_name,prefix) for lineage in lineages],dtype=bool)
+        if drop_empty:
+            keep&=np.asarray((block != 0).sum(axis=1)).ravel() > 0
+
+        block=select_rows(obs_ids,lineages,block,keep)
+        if block:
+            yield block
+
+def select_rows(obs_ids,lineages,block,keep):
+    """Return the (observation ids, lineages, sparse counts) block restricted to the rows where keep is True, or None if no rows are left."""
+    if keep.all():
+        return obs_ids,lineages,block
+    elif keep.any():
+        keep_idx=np.flatnonzero(keep)
+        return obs_ids[keep_idx],[lineages[i] for i in keep_idx],block[keep_idx]
+    return None
+
+def abundance_filter_blocks(blocks,table_total,min_total_count=None,min_rel_abundance=None,min_prevalence=None,stats=None):
+    """Drop observations from each block that fail the abundance and prevalence filters.
+
+    min_total_count is the minimum sum of counts across samples, min_rel_abundance the minimum
+    fraction of table_total (all counts in the table) and min_prevalence the minimum fraction of samples
+    with a non-zero count. The filters are computed on the sparse counts before any formatting.
+    If given, stats['kept'] and stats['dropped'] are incremented with the observation counts."""
+    for obs_ids,lineages,block in blocks:
+        totals=np.asarray(block.sum(axis=1)).ravel()
+        keep=np.ones(len(obs_ids),dtype=bool)
+        if min_total_count is not None:
+            keep&=totals >= min_total_count
+        if min_rel_abundance is not None:
+            keep&=totals >= min_rel_abundance*table_total
+        if min_prevalence is not None:
+            prevalence=np.asarray((block != 0).sum(axis=1)).ravel()/max(block.shape[1],1)
+            keep&=prevalence >= min_prevalence
+
+        if stats is not None:
+            num_kept=int(keep.sum())
+            stats['kept']+=num_kept
+            stats['dropped']+=len(keep)-num_kept
+
+        block=select_rows(obs_ids,lineages,block,keep)
+        if block:
+            yield block
+
+def load_biom_table(file_name,keep_sample_ids=None):
+    """Load a BIOM table, keeping only keep_sample_ids if given.
+
+    For HDF5 files the sample subset is applied while the table is read. Observation subsets are
+    applied to the loaded table by subset_blocks instead: reading only some observations with
+    Table.from_hdf5 would also drop the samples that are empty in them (see --stream)."""
+    if keep_sample_ids is None:
+        return load_table(file_name)
+    elif h5py.is_hdf5(file_name):
+        with h5py.File(file_name,'r') as biom_file:
+            return Table.from_hdf5(biom_file,ids=keep_sample_ids,axis='sample')
+    else:
+        table=load_table(file_name)
+        sample_index(table.ids(),keep_sample_ids)
+        return table.filter(keep_sample_ids,axis='sample',inplace=False)
+
+def metadata_depth(lineages,metadata_name):
+    """Determine how many hierarchy levels the metadata contains, given an iterable of the lineages
+    (starting with the lineage of the first observation)."""
     if metadata_name is None:
-        max_len_metadata=0
+        return 0
     elif metadata_name == 'KEGG_Description':
-        max_len_metadata=1
-    elif table.metadata(obs_ids[0],axis='observation') and metadata_name in table.metadata(obs_ids[0],axis='observation'):
-        max_len_metadata = max(len(table.metadata(p,axis='observation')[metadata_name]) for p in obs_ids)
+        return 1
+
+    lineages=iter(lineages)
+    first_lineage=next(lineages,None)
+    if first_lineage is not None:
+        return max(len(lineage) for lineage in chain([first_lineage],lineages))
     else:
         raise ValueError("'"+metadata_name+"' was not found in the BIOM table. Please try changing --metadata to a valid metadata field.")
 
-    include_obs_id=True
-    if metadata_name in ["KEGG_Pathways","KEGG_Description",'taxonomy']:
-        include_obs_id=False
+def obs_id_level(metadata_name):
+    """Whether the observation id is added as the last level (i.e. the metadata does not describe each observation on its own)."""
+    return metadata_name not in ["KEGG_Pathways","KEGG_Description",'taxonomy']
+
+def label_blocks(blocks,metadata_name,max_len_metadata,include_obs_id):
+    """Turn (observation ids, lineages, sparse counts) blocks into (row labels, sparse counts) blocks."""
+    for obs_ids,lineages,block in blocks:
+        labels=[obs_row_labels(obs_id,lineages[i],metadata_name,max_len_metadata,include_obs_id)
+                for i,obs_id in enumerate(obs_ids)]
+        yield labels,block
+
+def collapse_counts(labelled_blocks,levels,num_samples):
+    """Sum the counts of all rows sharing the same first level labels (e.g. the same lineage down to genus), for each of the levels.
+
+    The table is only read once: the rows of each block are summed into the groups of every level with
+    a single sparse aggregation matrix multiplication per level. Returns a dict mapping each level to
+    its groups (label tuples, in order of first appearance) and a sparse matrix with one row of summed
+    counts per group."""
+    group_codes=dict((level,{}) for level in levels)
+    collapsed=dict((level,csr_matrix((0,num_samples))) for level in levels)
+
+    for labels,block in labelled_blocks:
+        for level in levels:
+            codes=group_codes[level]
+            row_codes=np.array([codes.setdefault(tuple(row[:level]),len(codes)) for row in labels],dtype=np.int64)
+            aggregation=csr_matrix((np.ones(len(row_codes)),(row_codes,np.arange(len(row_codes)))),
+                                   shape=(len(codes),len(row_codes)))
+            collapsed[level].resize((len(codes),num_samples))
+            collapsed[level]=collapsed[level]+aggregation.dot(block)
+
+    return dict((level,(list(group_codes[level]),collapsed[level])) for level in levels)
+
+def iter_collapsed_blocks(groups,counts,chunk_size):
+    """Yield the collapsed groups and their counts as (row labels, sparse counts) blocks of chunk_size rows."""
+    for start in range(0,len(groups),chunk_size):
+        stop=min(start+chunk_size,len(groups))
+        yield [list(group) for group in groups[start:stop]],counts[start:stop]
 
+def write_spf_rows(labelled_blocks,count_format='shortest',precision=6,outfile=sys.stdout):
+    """Write the SPF rows for an iterable of (row labels, sparse counts) blocks.
+
+    Only one block of rows is densified at any point and each block is written with a single join."""
+    for labels,block in labelled_blocks:
+        counts=format_count_block(block,count_format,precision)
+
+        lines=["\t".join(row+counts[i].tolist()) for i,row in enumerate(labels)]
+
+        if lines:
+            outfile.write("\n".join(lines)+"\n")
+
+def write_spf(sample_ids,num_levels,labelled_blocks,count_format='shortest',precision=6,outfile=sys.stdout):
+    """Write the SPF header line followed by the rows of each block."""
     #make the header line
     header=[]
 
-    #make simple labels for each level in the metadata (e.g. 'Level_1', 'Level_2', etc.) "+1" for the observation id as well.
-    extra_levels=0
-    if include_obs_id:
-        extra_levels=1
-        
-    for i in range(max_len_metadata+extra_levels):
+    #make simple labels for each level (e.g. 'Level_1', 'Level_2', etc.)
+    for i in range(num_levels):
         header.append('Level_'+ str(i+1))
     
     #add the sample ids to the header line
-    header.extend(table.ids())
+    header.extend(sample_ids)
     
-    print("\t".join(header))
-
-    #now process each observation (row in the table)
-    for obs_vals,obs_id,obs_metadata in table.iter(axis='observation'):
-        row=[]
-        if max_len_metadata >0:
-            row=process_metadata(obs_metadata[metadata_name],metadata_name,obs_id)
-        
-        #Add 'Unclassified' if the metadata doesn't fill each level
-        len_defined_metadata=len(row)
-        if len_defined_metadata < max_len_metadata:
-            for i in range(max_len_metadata - len_defined_metadata):
-                row.append('Unclassified')
-
-        if include_obs_id:
-            #Add the observation id as the last "Level"
-            if obs_id.isdigit():
-                #Need to add something to the id if it a number identfier (e.g. gg OTU ids)
-                row.append('ID'+'_'+obs_id)
-            else:
-                row.append(obs_id)
+    print("\t".join(header),file=outfile)
+
+    #now process each observation (row in the table) in blocks of rows
+    write_spf_rows(labelled_blocks, count_format, precision, outfile)
+
+def write_spf_file(out_file,sample_ids,num_levels,labelled_blocks,count_format='shortest',precision=6):
+    """Write an SPF to the path out_file, or to STDOUT if out_file is None."""
+    if out_file is None:
+        write_spf(sample_ids,num_levels,labelled_blocks,count_format,precision,sys.stdout)
+    else:
+        with open(out_file,'w') as outfile:
+            write_spf(sample_ids,num_levels,labelled_blocks,count_format,precision,outfile)
+
+def collapsed_file_name(out_file,level):
+    """Name of the SPF for one collapse level when several are written (e.g. otu_L6.spf for otu.spf)."""
+    if out_file.endswith('.spf'):
+        out_file=out_file[:-len('.spf')]
+    return out_file+'_L'+str(level)+'.spf'
+
+def export_spf(file_name,sample_ids,blocks,table_total,metadata_name,max_len_metadata,count_format,args,out_file=None):
+    """Apply the abundance/prevalence filters and collapsing in args to the blocks of a BIOM file and write them as SPF.
+
+    With several collapse levels the table is labelled once, collapsed to every level in the same
+    pass and each level is written to its own SPF."""
+    filters=(args.min_total_count,args.min_rel_abundance,args.min_prevalence)
+    use_filters=any(f is not None for f in filters)
+
+    stats={'kept':0,'dropped':0}
+    if use_filters:
+        blocks=abundance_filter_blocks(blocks,table_total,*filters,stats=stats)
+
+    if args.collapse_level:
+        if max_len_metadata == 0:
+            raise ValueError("--collapse_level requires hierarchical --metadata: "+file_name)
+        levels=sorted(set(min(level,max_len_metadata) for level in args.collapse_level))
+
+        labelled_blocks=label_blocks(blocks,metadata_name,max_len_metadata,False)
+        collapsed=collapse_counts(labelled_blocks,levels,len(sample_ids))
+
+        for level in levels:
+            groups,counts=collapsed[level]
+            level_file=out_file if len(levels) == 1 else collapsed_file_name(out_file,level)
+            write_spf_file(level_file,sample_ids,level,iter_collapsed_blocks(groups,counts,args.chunk_size),
+                           count_format,args.precision)
+    else:
+        #"+1" for the observation id as well
+        include_obs_id=obs_id_level(metadata_name)
+        labelled_blocks=label_blocks(blocks,metadata_name,max_len_metadata,include_obs_id)
+        num_levels=max_len_metadata+(1 if include_obs_id else 0)
+        write_spf_file(out_file,sample_ids,num_levels,labelled_blocks,count_format,args.precision)
+
+    if use_filters:
+        print("%s: dropped %d of %d observations with the abundance/prevalence filters" %
+              (file_name,stats['dropped'],stats['kept']+stats['dropped']),file=sys.stderr)
+
+def convert_biom(file_name,metadata_name,args,out_file=None):
+    """Convert a single BIOM file to SPF, using the conversion options in args.
+
+    The SPF is written to the path out_file (or STDOUT if None)."""
+    keep_sample_ids=read_id_list(args.sample_ids) if args.sample_ids else None
+    keep_obs_ids=read_id_list(args.observation_ids) if args.observation_ids else None
+    prefix=parse_metadata_prefix(args.metadata_prefix) if args.metadata_prefix else None
+
+    if args.stream:
+        if not h5py.is_hdf5(file_name):
+            raise ValueError("--stream requires a BIOM v2.1 (HDF5) input file: "+file_name)
+        with h5py.File(file_name,'r') as biom_file:
+            sample_ids=biom_file['sample/ids'].asstr()[:]
+            sample_idx=None
+            if keep_sample_ids is not None:
+                sample_idx=sample_index(sample_ids,keep_sample_ids)
+                sample_ids=sample_ids[sample_idx]
+            max_len_metadata=metadata_depth(iter_hdf5_lineages(biom_file,metadata_name,args.chunk_size),metadata_name)
+            count_format=resolve_count_format(args.count_format,iter_hdf5_data(biom_file,args.chunk_size*max(len(sample_ids),1)))
+            #only the rows of the kept observation ids are read
+            obs_idx=hdf5_obs_index(biom_file,keep_obs_ids) if keep_obs_ids is not None else None
+            blocks=iter_hdf5_blocks(biom_file,metadata_name,args.chunk_size,sample_idx,obs_idx)
+            blocks=subset_blocks(blocks,metadata_name,None,prefix,keep_sample_ids is not None)
+            table_total=None
+            if args.min_rel_abundance is not None:
+                #an extra pass over the counts only (no metadata) to get the table total
+                table_total=sum(block.sum() for obs_ids,lineages,block in iter_hdf5_blocks(biom_file,None,args.chunk_size,sample_idx))
+            export_spf(file_name,sample_ids,blocks,table_total,metadata_name,max_len_metadata,count_format,args,out_file)
+    else:
+        table = load_biom_table(file_name,keep_sample_ids)
+        sample_ids=table.ids()
+        #extract the metadata column once; it serves both the depth and the row labels
+        obs_metadata=table.metadata(axis='observation') or [None]*table.shape[0]
+        lineages,codes=index_lineages(obs_metadata,metadata_name)
+        max_len_metadata=metadata_depth(lineages,metadata_name)
+        count_format=resolve_count_format(args.count_format,[table.matrix_data.data])
+        blocks=iter_table_blocks(table,lineages,codes,args.chunk_size)
+        blocks=subset_blocks(blocks,metadata_name,keep_obs_ids,prefix,keep_sample_ids is not None)
+        export_spf(file_name,sample_ids,blocks,table.matrix_data.sum(),metadata_name,max_len_metadata,count_format,args,out_file)
+
+def convert_biom_to_file(job):
+    """Pool worker: convert one (BIOM file, metadata field, output SPF, options) job."""
+    file_name,metadata_name,out_file,args=job
+    convert_biom(file_name,metadata_name,args,out_file)
+    return out_file
+
+def read_manifest(manifest_file,default_metadata):
+    """Read a manifest with one BIOM file per line and an optional tab-separated metadata field.
+
+    Lines without a metadata field use default_metadata (i.e. --metadata). Returns a list of
+    (BIOM file, metadata field) tuples."""
+    jobs=[]
+    with open(manifest_file) as manifest:
+        for line in manifest:
+            line=line.rstrip("\r\n")
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields=line.split("\t")
+            metadata_name=fields[1] if len(fields) > 1 and fields[1] else default_metadata
+            jobs.append((fields[0],metadata_name))
+    return jobs
+
+def spf_file_name(file_name,output_dir):
+    """Name of the output SPF for a BIOM file when converting in batch mode (e.g. out/otu.spf for otu.biom)."""
+    out_name=basename(file_name)
+    if out_name.endswith('.biom'):
+        out_name=out_name[:-len('.biom')]
+    return join(output_dir,out_name+'.spf')
+
+def main():
+    args = parser.parse_args()
+
+    if args.collapse_level is not None and min(args.collapse_level) < 1:
+        parser.error("--collapse_level must be at least 1")
+
+    jobs=[(file_name,args.metadata) for file_name in args.biom_file]
+    if args.manifest:
+        jobs.extend(read_manifest(args.manifest,args.metadata))
+
+    if not jobs:
+        parser.error("at least one BIOM file (or --manifest) is required")
+
+    #a single table without an output directory is written to STDOUT
+    if len(jobs) == 1 and args.output_dir is None:
+        if args.collapse_level is not None and len(set(args.collapse_level)) > 1:
+            parser.error("--output_dir is required when writing more than one --collapse_level")
+        convert_biom(jobs[0][0],jobs[0][1],args)
+        return
+
+    if args.output_dir is None:
+        parser.error("--output_dir is required when converting more than one BIOM file")
+
+    out_files=[spf_file_name(file_name,args.output_dir) for file_name,metadata_name in jobs]
+    if len(set(out_files)) != len(out_files):
+        parser.error("input BIOM files must have distinct file names in batch mode")
+
+    if not exists(args.output_dir):
+        makedirs(args.output_dir)
+
+    jobs=[(file_name,metadata_name,out_file,args) for (file_name,metadata_name),out_file in zip(jobs,out_files)]
+
+    if args.processes > 1:
+        #each worker imports biom once and then converts many files
+        pool=Pool(args.processes)
+        pool.map(convert_biom_to_file,jobs,chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            convert_biom_to_file(job)
 
-        #Add count data to the row
-        row.extend(map(str,obs_vals))
-        print("\t".join(row))
-        
-    
 
 if __name__ == "__main__":
     main()
-
@@ -2,18 +2,27 @@
 
 from __future__ import print_function
 import argparse
-import csv
 import pandas as pd
 import numpy as np
-from os import path
 import sys
+import os
 import re
-from tempfile import TemporaryDirectory
 
 __author__ = "Gavin Douglas"
 __license__ = "GPL"
 __version__ = "0.3"
 
+# Default (case-insensitive) strings marking labels replaced by --replace_ambig.
+AMBIG_STRINGS = ['uncultured', 'ambiguous_taxa', 'metagenome', 'unidentified']
+UNKNOWN_STRINGS = ['unknown']
+
+# Labels treated as missing (the strings pandas reads as missing values by
+# default), whichever way the file is read. They are written out as empty
+# fields.
+MISSING_LABELS = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN',
+                  '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+                  'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
 parser = argparse.ArgumentParser(
 
 description="Fix STAMP-formatted OTU table so all level labels in the file form a strict "
@@ -49,6 +58,52 @@ parser.add_argument("-c", "--col_count", required=False, default=7, type=int,
                          "correspond to taxonomic levels such as Kingdom, "
                          "Phylum, etc.")
 
+parser.add_argument("--passthrough_counts", required=False, default=False,
+                    action='store_true',
+                    help="Only parse the label columns (see --col_count) "
+                         "and copy the rest of each line (the counts) to the "
+                         "output untouched. This is faster and uses less "
+                         "memory for wide tables and keeps the count values "
+                         "exactly as they are in the input (otherwise they "
+                         "are re-formatted, e.g. \"1\" becomes \"1.0\").")
+
+parser.add_argument("--stream", required=False, default=False,
+                    action='store_true',
+                    help="Fix SPF files that are too big to read into memory "
+                         "by reading the file twice: first only the label "
+                         "columns to work out the fixed labels of each "
+                         "distinct lineage and then line by line to write "
+                         "out the fixed labels. Memory use depends on the "
+                         "number of distinct lineages only. Counts are "
+                         "passed through untouched (see "
+                         "--passthrough_counts).")
+
+parser.add_argument("--write_map", required=False, default=None,
+                    help="Also write the computed rewrite map (each distinct "
+                         "original lineage followed by its fixed lineage, "
+                         "tab-separated, one lineage per line) to this file. "
+                         "The map can be applied to other SPF files with "
+                         "--apply_map so that labels are fixed consistently "
+                         "across batches.")
+
+parser.add_argument("--apply_map", required=False, default=None,
+                    help="Skip fixing the labels and instead stream the input "
+                         "SPF through a rewrite map written previously with "
+                         "--write_map (one lookup per line). Counts are "
+                         "passed through untouched. Stops with an error if a "
+                         "lineage is not in the map.")
+
+parser.add_argument("--state", required=False, default=None,
+                    help="Hierarchy state file that keeps the \"_dupN\" "
+                         "suffixes consistent across runs (e.g. when new "
+                         "sample batches arrive). The child/parent label "
+                         "pairs (and their assigned N) already in this file "
+                         "are kept, pairs from new lineages are added to it "
+                         "and the file is then saved again. It is created if "
+                         "it does not exist. Note that a label seen with a "
+                         "single parent so far will gain a suffix once it is "
+                         "seen with a second parent.")
+
 parser.add_argument("--replace_ambig", required=False, default=False,
                     action='store_true',
                     help="When set all ambiguous labels (see script "
@@ -58,88 +113,128 @@ parser.add_argument("--replace_ambig", required=False, default=False,
                          "\"unknown\" with the preceeding label followed by "
                          "\"X\".")
 
+parser.add_argument("--ambig_strings", required=False,
+                    default=",".join(AMBIG_STRINGS),
+                    help="Comma-separated (case-insensitive) strings marking "
+                         "labels to replace with \"Unclassified\" when "
+                         "--replace_ambig is set (default=%(default)s).")
 
-def replace_ambig_labels(in_spf, out_spf, col_count):
-    '''Function to read in a SPF and to replace all labels containing
-    "uncultured", "Ambiguous_taxa", "metagenome", or "unidentified", with
-    "Unclassified". In addition, when this option is set it will also replace
-    labels containing "unknown with the preceeding label followed by "X". Will
-    write out the new SPF.'''
+parser.add_argument("--unknown_strings", required=False,
+                    default=",".join(UNKNOWN_STRINGS),
+                    help="Comma-separated (case-insensitive) strings marking "
+                         "labels to replace with the preceeding label "
+                         "followed by \"_X\" when --replace_ambig is set "
+                         "(default=%(default)s).")
 
-    outfile = open(out_spf, "w")
-    out_writer = csv.writer(outfile, delimiter="\t", lineterminator="\n")
 
-    str2replace = ['uncultured', 'ambiguous_taxa', 'metagenome',
-                   'unidentified']
+def make_label_matcher(ambig_strings=AMBIG_STRINGS,
+                       unknown_strings=UNKNOWN_STRINGS):
+    '''Return a function that classifies a label as "ambig" if it contains
+    any of ambig_strings, "unknown" if it contains any of unknown_strings
+    (and none of ambig_strings) or None otherwise (all case-insensitive).
+    The strings of each type are matched with a single precompiled pattern
+    (ambig_strings first) and the result for each label is memoized since
+    labels repeat heavily across rows.'''
 
-    header_marker = 0
+    # One pattern per label type, since a match of one type could otherwise
+    # hide an overlapping match of the other.
+    patterns = []
+    for label_type, strings in [("ambig", ambig_strings),
+                                ("unknown", unknown_strings)]:
+        strings = [s for s in strings if s]
+        if strings:
+            patterns.append((label_type,
+                             re.compile("|".join(re.escape(s.lower())
+                                                 for s in strings))))
 
-    with open(in_spf, "r") as infile:
+    label_types = {}
 
-        for line in infile:
+    def match_label(label):
 
-            # Remove newline character and split by tab.
-            line = line.rstrip("\r\n")
-            line_split = line.split("\t")
+        if label in label_types:
+            return(label_types[label])
 
-            # Print out header and go to next line.
-            if header_marker == 0:
-                header_marker += 1
-                outfile.write(line + "\n")
-                continue
+        label_type = None
 
-            # If no labels are in the set to replace then print out line and
-            # move to next one.
-            str_matches = 0
+        # Ambiguous strings are checked first.
+        lower_label = label.lower()
+        for pattern_type, pattern in patterns:
+            if pattern.search(lower_label):
+                label_type = pattern_type
+                break
 
-            for s in str2replace + ['unknown']:
-                if s in line.lower():
-                    str_matches += 1
+        label_types[label] = label_type
 
-            if str_matches == 0:
-                outfile.write(line + "\n")
-                continue
+        return(label_type)
+
+    return(match_label)
 
-            # Get list of all taxonomic levels.
-            taxa = line_split[0:col_count]
 
-            # Loop through taxa and replace any ids in set of strings to
-            # replace with "Unclassified". For any taxa containing "unknown",
-            # replace these ids with the preceeding taxonomic level, but with
-            # the correct DX level and followed by "_X".
-            out_taxa = []
+default_label_matcher = make_label_matcher()
 
-            # Loop over each label (from higher to lower levels).
-            for label_i, label in enumerate(taxa):
-                str_match = False
 
-                for s in str2replace:
-                    if s in label.lower():
-                        str_match = True
-                        break
+def replace_ambig_taxa(taxa, match_label=default_label_matcher):
+    '''Replace all labels of a single lineage (list of labels from higher to
+    lower levels) containing "uncultured", "Ambiguous_taxa", "metagenome", or
+    "unidentified", with "Unclassified". Labels containing "unknown" are
+    replaced with the preceeding label followed by "_X". A different set of
+    strings can be used by passing a match_label function (see
+    make_label_matcher). Returns the new list of labels.'''
+
+    # Loop through taxa and replace any ids in set of strings to
+    # replace with "Unclassified". For any taxa containing "unknown",
+    # replace these ids with the preceeding taxonomic level, but with
+    # the correct DX level and followed by "_X".
+    out_taxa = []
+
+    # Loop over each label (from higher to lower levels).
+    for label_i, label in enumerate(taxa):
+
+        # Missing labels (e.g. empty cells read in by pandas) are kept as is.
+        if not isinstance(label, str):
+            out_taxa.append(label)
+            continue
+
+        label_type = match_label(label)
+
+        if label_type == "ambig":
+            out_taxa.append('Unclassified')
+
+        elif label_type == "unknown":
+            pre_label_i = label_i - 1
+
+            if pre_label_i < 0 or out_taxa[pre_label_i] == 'Unclassified':
+                out_taxa.append('Unclassified')
+            else:
+                pre_label_search = re.search(r"D_\d+__(.*)",
+                                             out_taxa[pre_label_i])
+                pre_label_taxon = pre_label_search.group(1)
+                label_level = re.match(r"D_\d+__", label).group(0)
+                out_taxa.append(label_level + pre_label_taxon + "_X")
+
+        else:
+            out_taxa.append(label)
 
-                if str_match:
-                    out_taxa.append('Unclassified')
+    return(out_taxa)
 
-                elif 'unknown' in label.lower():
-                    pre_label_i = label_i - 1
 
-                    if pre_label_i < 0 or out_taxa[pre_label_i] == 'Unclassified':
-                        out_taxa.append('Unclassified')
-                    else:
-                        pre_label_search = re.search(r"D_\d+__(.*)",
-                                                     out_taxa[pre_label_i])
-                        pre_label_taxon = pre_label_search.group(1)
-                        label_level = re.match(r"D_\d+__", label).group(0)
-                        out_taxa.append(label_level + pre_label_taxon + "_X")
+def replace_ambig_lineages(lineages, col_count,
+                           match_label=default_label_matcher):
+    '''Replace ambiguous labels (see replace_ambig_taxa) in the first
+    col_count columns of pandas df (e.g. the distinct lineages of an SPF file).
+    Returns a new df.'''
 
-                else:
-                    out_taxa.append(label)
+    lineages = lineages.copy()
 
-            line_split[0:col_count] = out_taxa
-            out_writer.writerow(line_split)
+    taxa = lineages.iloc[:, 0:col_count].itertuples(index=False, name=None)
 
-    outfile.close()
+    new_taxa = np.empty((len(lineages), col_count), dtype=object)
+    for row_i, row_taxa in enumerate(taxa):
+        new_taxa[row_i, :] = replace_ambig_taxa(row_taxa, match_label)
+
+    lineages.iloc[:, 0:col_count] = new_taxa
+
+    return(lineages)
 
 
 def check_intermediate_unclassified(orig_spf, col_count):
@@ -152,60 +247,73 @@ def check_intermediate_unclassified(orig_spf, col_count):
 
     max_col_i = col_count - 1
 
-    # Making a copy of this dataframe because the pandas dataframe being iterated
-    # over should not be modified.
+    # Making a copy of this dataframe so that the input dataframe is not
+    # modified.
     new_spf = orig_spf.copy()
 
-    for row_i, row in orig_spf.iterrows():
+    taxa = orig_spf.iloc[:, 0:max_col_i].to_numpy(dtype=object, copy=True)
 
-        taxa = list(orig_spf.iloc[row_i, 0:max_col_i])
+    if taxa.size == 0:
+        return(new_spf)
 
-        unclassified_i = []
-        classified_i = []
+    # Encode the labels as a boolean matrix of 'Unclassified' labels.
+    unclassified = taxa == 'Unclassified'
+    level_i = np.arange(taxa.shape[1])
 
-        for i, t in enumerate(taxa):
-            if t == 'Unclassified':
-                unclassified_i.append(i)
-            else:
-                classified_i.append(i)
+    # Index of the nearest classified level at or above each level of each
+    # row (-1 when there is none).
+    nearest_classified = np.maximum.accumulate(np.where(unclassified, -1,
+                                                        level_i), axis=1)
 
-        if unclassified_i and min(unclassified_i) < max(classified_i):
+    # Intermediate Unclassified labels are those above the lowest classified
+    # level of their row.
+    lowest_classified = nearest_classified[:, -1]
+    intermediate = unclassified & (level_i < lowest_classified[:, np.newaxis])
 
-            # Check whether first level is classified or not.
-            if taxa[0] == 'Unclassified':
-                sys.exit("Stopping - first level of this lineage is Unclassified, "
-                         "but lower levels are classified:\n" + " ".join(taxa))
+    if not intermediate.any():
+        return(new_spf)
 
-            # For any cases of intermediate Unclassified labels, fill in the
-            # nearest classified parent label followed by X's equal to the number
-            # of steps away this classified label is.
-            for unclass_i in unclassified_i:
+    # Check whether first level is classified or not.
+    unclassified_first = intermediate.any(axis=1) & unclassified[:, 0]
 
-                if unclass_i < max(classified_i):
-                    current_i = unclass_i
-                    unclassified_steps = 1
+    if unclassified_first.any():
+        sys.exit("Stopping - first level of this lineage is Unclassified, "
+                 "but lower levels are classified:\n" +
+                 " ".join(taxa[np.argmax(unclassified_first)]))
 
-                    while current_i > 0:
-                        current_i -= 1
+    # For any cases of intermediate Unclassified labels, fill in the nearest
+    # classified parent label followed by X's equal to the number of steps
+    # away this classified label is.
+    row_i, unclass_i = np.nonzero(intermediate)
+    parent_i = nearest_classified[row_i, unclass_i]
 
-                        if taxa[current_i] == 'Unclassified' or \
-                           current_i not in classified_i:
-                            unclassified_steps += 1
-                            next
-                        else:
-                            taxa[unclass_i] = taxa[current_i] + "_" + "X" * unclassified_steps
-                            break
+    filled_labels = np.char.add(np.char.add(taxa[row_i, parent_i].astype(str), "_"),
+                                np.char.multiply("X", unclass_i - parent_i))
 
-        new_spf.iloc[row_i, 0:max_col_i] = taxa
+    taxa[row_i, unclass_i] = filled_labels
+
+    new_spf.iloc[:, 0:max_col_i] = taxa
 
     return(new_spf)
 
 
-def force_strict_spf_hierarchy(in_spf, col_count):
+def force_strict_spf_hierarchy(in_spf, col_count, state=None):
     '''Read through pandas df (of SPF file) and check that all levels form
     a strict hierarchy. Returns fixed df with "_dupN" added to the end of
     identical children with different parents. Note that col_count refers to
-    the number of taxonomic columns at the start of the file.'''
+    the number of taxonomic columns at the start of the file.
+    Parents are identified by their lineage of original labels (see
+    parent_lineages), which does not change when a parent itself gains a
+    "_dupN" suffix. If state is set (a dict of hierarchy state, see
+    read_hierarchy_state) the child/parent pairs seen in previous runs are
+    taken into account and N is kept for known pairs, so the same labels get
+    the same suffixes across runs. New pairs are added to state in place.'''
+
+    if state is None:
+        state = {}
+
+    # Lineage of the parents of the current column.
+    lineages = pd.Series(in_spf.iloc[:, 0].to_numpy(), dtype=object)
 
     # Loop over all columns with labels.
     for i in range(col_count):
@@ -215,68 +323,464 @@ def force_strict_spf_hierarchy(in_spf, col_count):
             continue
 
         current_col = in_spf.columns[i]
-        prior_col = in_spf.columns[i - 1]
-        unique_labels = in_spf[current_col].unique()
 
-        for label in unique_labels:
+        children = pd.DataFrame({'label': in_spf[current_col].to_numpy(),
+                                 'parent_lineage': lineages.to_numpy()})
+
+        lineages = parent_lineages(children['label'], lineages)
+
+        # Distinct child/parent pairs in order of first appearance, skipping
+        # Unclassified labels.
+        pairs = children.drop_duplicates()
+        pairs = pairs[pairs['label'].notna() &
+                      (pairs['label'] != "Unclassified")]
+
+        # Only add the pairs not already in the state for this level. N is
+        # the index of the parent in the order the parents first appear
+        # (across runs when a state is kept).
+        known = state.get(i, pd.DataFrame({'label': pd.Series(dtype=object),
+                                           'parent_lineage': pd.Series(dtype=object),
+                                           'dup': pd.Series(dtype=int)}))
+
+        new_pairs = pairs.merge(known[['label', 'parent_lineage']],
+                                how='left', on=['label', 'parent_lineage'],
+                                indicator=True)
+        new_pairs = new_pairs.loc[new_pairs['_merge'] == 'left_only',
+                                  ['label', 'parent_lineage']]
+
+        if not new_pairs.empty:
+            num_known = new_pairs['label'].map(known.groupby('label').size())
+            new_pairs = new_pairs.assign(
+                dup=num_known.fillna(0).astype(int).to_numpy() +
+                new_pairs.groupby('label', sort=False).cumcount().to_numpy())
+
+            known = pd.concat([known, new_pairs], ignore_index=True)
+            state[i] = known
+
+        # Count the distinct parents of each child label with a single
+        # group-by and keep only the labels with multiple parents (i.e. not a
+        # strict hierarchy).
+        num_parents = known.groupby('label', sort=False)['parent_lineage'].transform('size')
+        conflicts = known[num_parents > 1]
+
+        if conflicts.empty:
+            continue
+
+        # Add "_dupN" to all children with different parents.
+        conflicts = conflicts.assign(new_label=conflicts['label'] + "_dup" +
+                                     conflicts['dup'].astype(str))
+        conflicts = conflicts[conflicts['parent_lineage'].notna()]
+
+        # Relabel all conflicting children in one vectorized map.
+        new_labels = children.merge(conflicts[['label', 'parent_lineage',
+                                               'new_label']],
+                                    how='left',
+                                    on=['label', 'parent_lineage'])['new_label']
+
+        in_spf[current_col] = np.where(new_labels.notna(), new_labels,
+                                       children['label'])
+
+    return(in_spf)
+
+
+def parent_lineages(labels, lineages):
+    '''Return the lineages identifying the (original) labels of a column as
+    parents of the next column, given the lineages of their own parents: the
+    labels joined by ";" to their parent lineage. Lineages start over at
+    "Unclassified" labels (which are never given a suffix) and after missing
+    labels (which start an empty lineage), so two labels have the same
+    lineage exactly when they end up with the same fixed label.'''
+
+    lineages = lineages.fillna("") + ";" + labels
+
+    return(lineages.mask(labels == "Unclassified", "Unclassified"))
+
+
+def read_hierarchy_state(state_file):
+    '''Read in hierarchy state file (written by write_hierarchy_state) with
+    one child/parent pair per line: the index of the level (column) of the
+    child label, the child label, the lineage of the parent label (see
+    parent_lineages) and N of the "_dupN" suffix assigned to this pair.
+    Returns a dict mapping each level to a pandas df of its pairs.'''
+
+    pairs = pd.read_csv(state_file, sep='\t', keep_default_na=False,
+                        na_values=[""],
+                        dtype={'level': int, 'label': object,
+                               'parent_lineage': object, 'dup': int})
+
+    return({level: level_pairs.drop(columns='level').reset_index(drop=True)
+            for level, level_pairs in pairs.groupby('level', sort=True)})
+
+
+def write_hierarchy_state(state_file, state):
+    '''Write out hierarchy state (see read_hierarchy_state).'''
+
+    columns = ['level', 'label', 'parent_lineage', 'dup']
+
+    pairs = [level_pairs.assign(level=level)
+             for level, level_pairs in sorted(state.items())]
+
+    if pairs:
+        pairs = pd.concat(pairs, ignore_index=True)
+    else:
+        pairs = pd.DataFrame(columns=columns)
+
+    pairs[columns].to_csv(path_or_buf=state_file, sep='\t', header=True,
+                          index=False)
+
+
+def unique_lineages(in_spf, col_count):
+    '''Factorize the first col_count columns of pandas df (of SPF file) into
+    a df of the distinct lineages (in order of first appearance) and an array
+    with the index of each row's lineage in that df.'''
+
+    labels = in_spf.iloc[:, 0:col_count]
+
+    codes = labels.groupby(list(labels.columns), sort=False, dropna=False,
+                           observed=True).ngroup().to_numpy()
+
+    # The distinct lineages are few, so they are decoded to plain labels that
+    # the hierarchy fixes can freely relabel.
+    lineages = labels.drop_duplicates().reset_index(drop=True).astype(object)
+
+    return(lineages, codes)
+
+
+def fix_spf_lineages(in_spf, col_count, replace_ambig=False,
+                     match_label=default_label_matcher, state=None,
+                     rewrite_map=None):
+    '''Run the hierarchy fixes (force_strict_spf_hierarchy and
+    check_intermediate_unclassified) on the distinct lineages of pandas df
+    (of SPF file) only and broadcast the fixed labels back to every row. If
+    replace_ambig is set ambiguous labels are replaced first (see
+    replace_ambig_lineages), using the match_label function. If state is
+    set it is used and extended by force_strict_spf_hierarchy. If rewrite_map
+    (a dict) is set, each distinct original lineage (tuple of labels as read)
+    is added to it as a key of its fixed lineage.
+    Since each lineage is fixed the same way wherever it occurs, the result is
+    identical to fixing every row, but the work scales with the number of
+    distinct lineages rather than the number of rows. The distinct lineages
+    are fixed as plain (decoded) labels and the fixed labels are only
+    dictionary-encoded again when they are broadcast back.'''
+
+    original_lineages, codes = unique_lineages(in_spf, col_count)
+
+    # Missing labels (see MISSING_LABELS) are fixed as missing values, so
+    # labels are handled the same whether or not the file was read by pandas.
+    lineages = original_lineages.mask(original_lineages.isin(MISSING_LABELS))
+
+    if replace_ambig:
+        lineages = replace_ambig_lineages(lineages, col_count, match_label)
+
+    # Check and add in strict hierarchy of SPF levels.
+    lineages = force_strict_spf_hierarchy(lineages, col_count, state)
+
+    # Check whether any higher levels are 'Unclassified' while lower
+    # levels are classified. Fill in different labels if needed.
+    lineages = check_intermediate_unclassified(lineages, col_count)
+
+    # Missing labels are written out as empty fields.
+    lineages = lineages.fillna("")
+
+    if rewrite_map is not None:
+        rewrite_map.update(zip(original_lineages.itertuples(index=False,
+                                                            name=None),
+                               lineages.itertuples(index=False, name=None)))
+
+    # Broadcast the fixed labels back to every row as dictionary-encoded
+    # (categorical) columns.
+    out_spf = in_spf.copy(deep=False)
+
+    for i in range(col_count):
+        label_codes, label_categories = pd.factorize(lineages.iloc[:, i])
+        out_spf.isetitem(i, pd.Categorical.from_codes(label_codes[codes],
+                                                      label_categories))
+
+    return(out_spf)
+
+
+def split_spf_line(line, col_count):
+    '''Split a raw (bytes) SPF line into a tuple of its first col_count
+    fields (the labels) and the raw remainder of the line (the counts,
+    starting with the tab), which is never parsed.'''
+
+    line_split = line.rstrip(b"\r\n").split(b"\t", col_count)
+
+    taxa = tuple(label.decode("utf-8") for label in line_split[0:col_count])
+
+    if len(line_split) > col_count:
+        return(taxa, b"\t" + line_split[col_count])
+    else:
+        return(taxa, b"")
+
+
+def read_spf_labels(in_spf, col_count):
+    '''Read in SPF, but only split out the first col_count fields (the
+    labels) of each line. The remainder of each line (the counts) is kept as
+    raw bytes and never parsed. Returns the raw header line, a pandas df of
+    the labels and a list with the raw remainder of each line.'''
 
-            # Skip Unclassified labels.
-            if label == "Unclassified":
+    labels = []
+    count_fields = []
+
+    with open(in_spf, "rb") as infile:
+
+        header = infile.readline().rstrip(b"\r\n")
+
+        for line in infile:
+
+            # Skip blank lines (as pandas does).
+            if not line.rstrip(b"\r\n"):
                 continue
 
-            matching_rows = in_spf[current_col] == label
+            taxa, counts = split_spf_line(line, col_count)
+            labels.append(taxa)
+            count_fields.append(counts)
+
+    labels = pd.DataFrame(labels, columns=range(col_count), dtype=object)
+
+    return(header, labels.astype("category"), count_fields)
+
+
+def write_spf_labels(out_spf, header, labels, count_fields):
+    '''Write out SPF from the raw header line, the pandas df of labels and
+    the raw remainder of each line (see read_spf_labels).'''
+
+    with open(out_spf, "wb") as outfile:
+        outfile.write(header + b"\n")
 
-            # Skip if only 1 matching row.
-            if np.sum(matching_rows) == 1:
+        for taxa, counts in zip(labels.itertuples(index=False, name=None),
+                                count_fields):
+            outfile.write("\t".join(taxa).encode("utf-8") + counts + b"\n")
+
+
+def read_spf_lineages(in_spf, col_count):
+    '''First pass of the streaming mode: read only the labels of SPF and
+    return a pandas df of the distinct lineages (first col_count fields) in
+    order of first appearance. Memory use depends on the number of distinct
+    lineages rather than on the size of the file.'''
+
+    lineages = {}
+
+    with open(in_spf, "rb") as infile:
+
+        # Skip header.
+        infile.readline()
+
+        for line in infile:
+
+            # Skip blank lines (as pandas does).
+            if not line.rstrip(b"\r\n"):
                 continue
 
-            # Otherwise check whether all the parents are identical.
-            unique_parents = in_spf.loc[in_spf[current_col] == label, prior_col].unique()
+            lineages.setdefault(split_spf_line(line, col_count)[0], None)
+
+    return(pd.DataFrame(list(lineages), columns=range(col_count),
+                        dtype=object))
+
+
+def lineage_rewrite_map(lineages, col_count, replace_ambig=False,
+                        match_label=default_label_matcher, state=None):
+    '''Fix the hierarchy of pandas df of distinct lineages (see
+    fix_spf_lineages) and return a dict mapping each original lineage (tuple
+    of labels) to its fixed lineage.'''
+
+    rewrite_map = {}
+
+    fix_spf_lineages(lineages, col_count, replace_ambig, match_label, state,
+                     rewrite_map)
+
+    return(rewrite_map)
+
+
+def stream_spf_labels(in_spf, out_spf, col_count, rewrite_map):
+    '''Second pass of the streaming mode: stream SPF line by line, replacing
+    the labels of each line with a lookup in rewrite_map (original lineage ->
+    fixed lineage). The counts are written out untouched.'''
+
+    with open(in_spf, "rb") as infile, open(out_spf, "wb") as outfile:
+
+        outfile.write(infile.readline().rstrip(b"\r\n") + b"\n")
+
+        for line in infile:
+
+            # Skip blank lines (as pandas does).
+            if not line.rstrip(b"\r\n"):
+                continue
+
+            taxa, counts = split_spf_line(line, col_count)
+
+            try:
+                fixed_taxa = rewrite_map[taxa]
+            except KeyError:
+                sys.exit("Stopping - this lineage is not in the rewrite "
+                         "map:\n" + " ".join(taxa))
+
+            outfile.write("\t".join(fixed_taxa).encode("utf-8") +
+                          counts + b"\n")
+
+
+def write_rewrite_map(map_file, rewrite_map):
+    '''Write out rewrite map (original lineage -> fixed lineage) as a
+    tab-separated file with the labels of the original lineage followed by
+    the labels of the fixed lineage on each line.'''
+
+    with open(map_file, "w") as outfile:
+        for taxa, fixed_taxa in rewrite_map.items():
+            outfile.write("\t".join(taxa + fixed_taxa) + "\n")
+
 
-            # If multiple parents (i.e. not a strict hierarchy) then add
-            # "_dupN" to all children with different parents, where N is the
-            # parent's index in the above list.
-            if len(unique_parents) > 1:
-                for idx, p in enumerate(unique_parents):
-                    new_label = label + "_dup" + str(idx)
+def read_rewrite_map(map_file, col_count):
+    '''Read in rewrite map written by write_rewrite_map and return it as a
+    dict mapping each original lineage (tuple of col_count labels) to its
+    fixed lineage.'''
 
-                    # Identify rows matching the label and parent value of
-                    # interest.
-                    rows2change = np.logical_and(matching_rows,
-                                                 in_spf[prior_col] == p)
+    rewrite_map = {}
 
-                    in_spf.loc[rows2change, current_col] = new_label
+    with open(map_file, "r") as infile:
+
+        for line in infile:
+            line_split = line.rstrip("\r\n").split("\t")
+
+            if len(line_split) != 2 * col_count:
+                sys.exit("Stopping - expected " + str(2 * col_count) +
+                         " fields (see --col_count) in each line of rewrite "
+                         "map, but found " + str(len(line_split)) + ":\n" +
+                         line)
+
+            rewrite_map[tuple(line_split[0:col_count])] = \
+                tuple(line_split[col_count:])
+
+    return(rewrite_map)
+
+
+def compact_count_columns(in_spf, col_count):
+    '''Downcast the count columns (all columns after the first col_count) of
+    pandas df (of SPF file) to compact dtypes wherever this does not change
+    how the values are written out: integer columns to the smallest integer
+    type (e.g. int32) and float columns with only whole numbers smaller than
+    one million (or missing values) to float32.'''
+
+    for i in range(col_count, in_spf.shape[1]):
+        counts = in_spf.iloc[:, i]
+
+        if pd.api.types.is_integer_dtype(counts):
+            in_spf.isetitem(i, pd.to_numeric(counts, downcast="integer"))
+
+        elif pd.api.types.is_float_dtype(counts):
+            values = counts.to_numpy()
+            finite = values[~np.isnan(values)]
+
+            if np.all(finite == np.round(finite)) and \
+               np.all(np.abs(finite) < 1e6):
+                in_spf.isetitem(i, counts.astype(np.float32))
 
     return(in_spf)
 
 
+def read_spf(in_spf, col_count):
+    '''Read in SPF as pandas df with the first col_count columns (the
+    labels) as dictionary-encoded (categorical) columns and compact count
+    columns (see compact_count_columns). The labels are kept exactly as they
+    are in the file (missing labels are only masked when they are fixed, see
+    fix_spf_lineages), so they match the labels read by the other modes.'''
+
+    with open(in_spf, "r") as infile:
+        header = infile.readline().rstrip("\r\n").split("\t")
+
+    label_dtypes = {i: "category" for i in range(min(col_count, len(header)))}
+    count_na_values = {i: MISSING_LABELS for i in range(col_count,
+                                                         len(header))}
+
+    input_spf = pd.read_csv(filepath_or_buffer=in_spf, sep='\t',
+                            dtype=label_dtypes, keep_default_na=False,
+                            na_values=count_na_values)
+
+    return(compact_count_columns(input_spf, col_count))
+
+
+def fix_spf_file(in_spf, out_spf, col_count, passthrough_counts=False,
+                 replace_ambig=False, match_label=default_label_matcher,
+                 stream=False, write_map=None, apply_map=None,
+                 state=None):
+    '''Read in SPF, fix the hierarchy of its labels (after replacing
+    ambiguous labels if replace_ambig is set) and write it out. When
+    passthrough_counts is set only the label columns are parsed and the
+    count columns are written out exactly as they were read. When stream is
+    set the file is read twice instead of being held in memory: once to
+    build the lineage rewrite map and once to apply it line by line (the
+    counts are also passed through untouched). If write_map is set the
+    rewrite map is also written to this file (see write_rewrite_map). If
+    apply_map is set the labels are not fixed, but the SPF is instead
+    streamed through the rewrite map read from this file. If state is set
+    (see read_hierarchy_state) it is used to keep the "_dupN" suffixes
+    consistent with previous runs and is extended with any new lineages.'''
+
+    # Only filled in with the fixed lineages if it is written out.
+    rewrite_map = {} if write_map else None
+
+    if apply_map:
+        rewrite_map = read_rewrite_map(apply_map, col_count)
+
+        stream_spf_labels(in_spf, out_spf, col_count, rewrite_map)
+
+    elif stream:
+        lineages = read_spf_lineages(in_spf, col_count)
+
+        rewrite_map = lineage_rewrite_map(lineages, col_count, replace_ambig,
+                                          match_label, state)
+
+        stream_spf_labels(in_spf, out_spf, col_count, rewrite_map)
+
+    elif passthrough_counts:
+        header, labels, count_fields = read_spf_labels(in_spf, col_count)
+
+        labels = fix_spf_lineages(labels, col_count, replace_ambig,
+                                  match_label, state, rewrite_map)
+
+        write_spf_labels(out_spf, header, labels, count_fields)
+
+    else:
+        input_spf = read_spf(in_spf, col_count)
+
+        # Fix the hierarchy of the distinct lineages and write out table.
+        input_spf = fix_spf_lineages(input_spf, col_count, replace_ambig,
+                                     match_label, state, rewrite_map)
+
+        input_spf.to_csv(path_or_buf=out_spf, sep='\t', header=True,
+                         index=False)
+
+    if write_map:
+        write_rewrite_map(write_map, rewrite_map)
+
+
 def main():
 
     args = parser.parse_args()
 
-    if args.replace_ambig:
-        # Replace ambiguous labels and write out to temp directory.
-        # Note that this is done since the two functions used for cleaning up
-        # the SPF were not originally written to be used together.
-        with TemporaryDirectory() as temp_dir:
-            tmp_spf = path.join(temp_dir, "tmp_spf")
-            replace_ambig_labels(args.input, tmp_spf, args.col_count)
+    if args.write_map and args.apply_map:
+        parser.error("--write_map and --apply_map cannot be used together.")
 
-            # Read in SPF file after replacing ambiguous labels.
-            input_spf = pd.read_csv(filepath_or_buffer=tmp_spf, sep='\t')
+    if args.state and args.apply_map:
+        parser.error("--state and --apply_map cannot be used together.")
 
-    else:
-        input_spf = pd.read_csv(filepath_or_buffer=args.input, sep='\t')
+    state = None
 
-    # Check and add in strict hierarchy of SPF levels and write out table.
-    input_spf = force_strict_spf_hierarchy(input_spf, args.col_count)
+    if args.state:
+        if os.path.exists(args.state):
+            state = read_hierarchy_state(args.state)
+        else:
+            state = {}
 
-    # Check whether any higher levels are 'Unclassified' while lower
-    # levels are classified. Fill in different labels if needed.
-    input_spf = check_intermediate_unclassified(input_spf, args.col_count)
+    match_label = make_label_matcher(args.ambig_strings.split(","),
+                                     args.unknown_strings.split(","))
+
+    fix_spf_file(args.input, args.output, args.col_count,
+                 args.passthrough_counts, args.replace_ambig, match_label,
+                 args.stream, args.write_map, args.apply_map, state)
 
-    input_spf.to_csv(path_or_buf=args.output, sep='\t', header=True,
-                     index=False)
+    if args.state:
+        write_hierarchy_state(args.state, state)
 
 
 if __name__ == "__main__":
@@ -11,68 +11,276 @@ __email__ = "gavin.douglas@dal.ca"
 __status__ = "Development"
 
 import argparse
+import sys
+import gzip
+import hashlib
+from array import array
+import numpy as np
+from scipy.sparse import coo_matrix
 
-parser = argparse.ArgumentParser(description="Convert Metaphlan2 taxonomic relative abundances in STAMP format to legacy (tsv) BIOM format", 
+# rank names used to detect the level columns in the header
+RANK_NAMES = ["kingdom","phylum","class","order","family","genus","species","strain"]
+
+# number of output lines joined and written at once
+BLOCK_LINES = 10000
+
+parser = argparse.ArgumentParser(description="Convert Metaphlan2 taxonomic relative abundances in STAMP format to legacy (tsv) BIOM format or HDF5 BIOM format (--hdf5)", 
                                  epilog='''Usage example:
 
 metaphlan2_stamp_to_biom.py -i metaphlan2_taxonomy.spf -o metaphlan2_taxonomy_tsv.biom
 
+metaphlan2_stamp_to_biom.py -i metaphlan2_taxonomy.spf -o metaphlan2_taxonomy.biom --hdf5
+
+metaphlan2_stamp_to_biom.py -i sample1.spf sample2.spf sample3.spf -o merged_taxonomy.biom --hdf5
+
 '''
                                  ,formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument("-i","--input",help="Input STAMP file", required=True)
+parser.add_argument("-i","--input",help="Input STAMP file(s). Multiple files (e.g. per-sample profiles) are merged into one table by their taxonomy, with an abundance of 0 for taxa missing from a file. Each taxonomy can only be found once per file. With multiple files (or --hdf5) the abundances are read as numbers, so legacy TSV BIOM output writes them in their shortest form (e.g. 1.50000 becomes 1.5 and 0 becomes 0.0), while a single file is copied over as it is", nargs="+", required=True)
 
-parser.add_argument("-o","--output",help="Output legacy TSV BIOM file", required=True)
+parser.add_argument("-o","--output",help="Output legacy TSV BIOM file (or HDF5 BIOM file with --hdf5)", required=True)
 
-def main():
+parser.add_argument("--hdf5",help="Write compressed HDF5 BIOM (v2.1) directly instead of legacy TSV BIOM, with the taxonomy of each taxa as observation metadata (requires the biom-format and h5py packages)", action="store_true", default=False)
+
+parser.add_argument("--id_mode",help="How to assign an id to each taxa: \"number\" numbers the taxa from 1 in the order they are found, \"hash\" uses the first 16 hex digits of a hash of the taxonomy (labels joined by \";\"), which gives the same taxa the same id in every table (default=%(default)s)", choices=["number","hash"], default="number")
+
+parser.add_argument("-l","--level_count",help="Number of level (taxonomy) columns at the start of the input file(s). By default this is the number of leading header fields that are rank names (Kingdom, Phylum, Class, Order, Family, Genus, Species or Strain), e.g. 8 for MetaPhlAn2 and 7 for the non-MetaPhlAn2 output of metaphlan_to_stamp.pl", type=int, default=None)
+
+parser.add_argument("--gzip",help="Compress the legacy TSV BIOM output with gzip", action="store_true", default=False)
+
+def detect_level_count( header_split ):
+    '''Return the number of leading fields of a split header that are rank names (see RANK_NAMES) or 8 (the MetaPhlAn2 levels) if there are none'''
+
+    level_count = 0
+
+    for field in header_split:
+        if field.lower() not in RANK_NAMES:
+            break
+        level_count += 1
+
+    if level_count == 0:
+        return 8
+
+    return level_count
+
+def make_row_splitter( level_count ):
+    '''Return a function that splits a line of a STAMP file into a list of its level_count labels (the taxonomy) and the remaining fields (the sample values) as unsplit text, so they can be written out again without being split and re-joined. The split indices are only worked out once here'''
+
+    taxonomy_cols = slice( 0 , level_count )
+
+    def split_row( line ):
+
+        line_split = line.rstrip().split( "\t" , level_count )
+
+        if len(line_split) > level_count:
+            return line_split[taxonomy_cols], line_split[level_count]
+        else:
+            return line_split, ""
+
+    return split_row
+
+def hash_taxonomy( tax ):
+    '''Return a stable id for a taxonomy (labels joined by ";"): the first 16 hex digits of its BLAKE2b hash'''
+
+    return hashlib.blake2b( tax.encode("utf-8") , digest_size=8 ).hexdigest()
+
+def taxa_ids( taxonomies , id_mode ):
+    '''Return the id of each taxa in a list of taxonomies (list of labels for each taxa), either numbered from 1 or as a hash of the taxonomy (see hash_taxonomy), depending on id_mode'''
+
+    if id_mode == "hash":
+        return [ hash_taxonomy( ";".join( tax ) ) for tax in taxonomies ]
+    else:
+        return [ str(taxa_num) for taxa_num in range( 1 , len(taxonomies) + 1 ) ]
+
+def read_stamp_tables( input_files , level_count=None ):
+    '''Read one or more STAMP files and outer join them on the taxonomy (first level_count columns, detected from the header of each file by default, see detect_level_count), so taxa absent from a file get an abundance of 0 in all of its samples. Each file is streamed line by line and only the distinct taxonomies and the non-zero abundances (as numbers) are kept in memory. Returns a list of sample ids, a list of taxonomies (list of labels for each taxa, in the order they first appear) and a sparse matrix of abundances (taxa x samples)'''
+
+    # row index of each distinct taxonomy
+    taxa_index = {}
+
+    sample_ids = []
+
+    # only the non-zero abundances are kept, in compact arrays
+    data = array( "d" )
+    rows = array( "q" )
+    cols = array( "q" )
+
+    # number of level columns of all files
+    table_level_count = None
+
+    for input_file in input_files:
+
+        with open( input_file , "r" ) as infile:
+
+            header = infile.readline()
+
+            file_level_count = level_count or detect_level_count( header.rstrip().split("\t") )
+
+            if table_level_count is None:
+                table_level_count = file_level_count
+            elif file_level_count != table_level_count:
+                sys.exit( "Stopping - " + input_file + " has " + str(file_level_count) + " level columns, but the previous input files have " + str(table_level_count) )
+
+            split_row = make_row_splitter( file_level_count )
+
+            # samples of this file follow the samples of the previous files
+            col_offset = len(sample_ids)
+            sample_ids.extend( split_row( header )[1].split("\t") )
+
+            # rows of the taxonomies already found in this file
+            file_taxa_rows = set()
+
+            # the header is line 1
+            for line_num, line in enumerate( infile , 2 ):
 
-    # Each metaphlan2 taxa will be given an unique number as an id 
+                # skip blank lines (e.g. at the end of the file)
+                if not line.strip():
+                    continue
+
+                taxonomy, values = split_row( line )
+
+                try:
+                    abundances = np.array( values.split("\t") , dtype=float )
+                except ValueError:
+                    sys.exit( "Stopping - line " + str(line_num) + " of " + input_file + " has sample values that are not numbers:\n" + line.rstrip() )
+
+                if len(abundances) != len(sample_ids) - col_offset:
+                    sys.exit( "Stopping - line " + str(line_num) + " of " + input_file + " has " + str(len(abundances)) + " sample values, but the header has " + str(len(sample_ids) - col_offset) + " samples" )
+
+                taxa_row = taxa_index.setdefault( tuple( taxonomy ) , len(taxa_index) )
+
+                # a repeated taxonomy would otherwise be summed into one row
+                if taxa_row in file_taxa_rows:
+                    sys.exit( "Stopping - line " + str(line_num) + " of " + input_file + " repeats the taxonomy of an earlier line:\n" + ";".join( taxonomy ) )
+                file_taxa_rows.add( taxa_row )
+
+                nonzero = np.flatnonzero( abundances )
+
+                data.frombytes( abundances[nonzero].tobytes() )
+                rows.frombytes( np.full( len(nonzero) , taxa_row , dtype=np.int64 ).tobytes() )
+                cols.frombytes( ( nonzero + col_offset ).astype(np.int64).tobytes() )
+
+    if len(set(sample_ids)) != len(sample_ids):
+        sys.exit( "Stopping - the same sample id is found more than once in the input files" )
+
+    abundances = coo_matrix( ( np.frombuffer( data , dtype=np.float64 ) ,
+                               ( np.frombuffer( rows , dtype=np.int64 ) , np.frombuffer( cols , dtype=np.int64 ) ) ) ,
+                             shape=( len(taxa_index) , len(sample_ids) ) ).tocsr()
+
+    taxonomies = [ list(tax) for tax in taxa_index ]
+
+    return sample_ids, taxonomies, abundances
+
+def tsv_biom_lines( sample_ids , taxonomies , abundances , id_mode="number" ):
+    '''Generate the lines of a legacy TSV BIOM file from a list of sample ids, a list of taxonomies and a sparse matrix of abundances (see read_stamp_tables) with taxa ids assigned according to id_mode (see taxa_ids)'''
+
+    yield "\t".join( ["#taxa"] + sample_ids + ["taxonomy"] )
+
+    ids = taxa_ids( taxonomies , id_mode )
+
+    # abundances are converted to text a block of rows at a time
+    for start in range( 0 , len(taxonomies) , BLOCK_LINES ):
+
+        block = abundances[start:start + BLOCK_LINES].toarray().astype(str)
+
+        for taxa_id, values, tax in zip( ids[start:start + BLOCK_LINES] , block , taxonomies[start:start + BLOCK_LINES] ):
+            yield taxa_id + "\t" + "\t".join( values ) + "\t" + ";".join( tax )
+
+def stamp_to_tsv_biom_lines( infile , level_count=None , id_mode="number" ):
+    '''Generate the lines of a legacy TSV BIOM file from the lines of a single STAMP file. The sample values are copied over as they are in the STAMP file'''
+
+    # Each metaphlan2 taxa will be given an unique number as an id (unless --id_mode hash is set)
     taxa_num = 1
 
     header_marker = 0
 
-    args = parser.parse_args()
+    for line in infile:
+
+        # if this integer == 0 then that means it's the first line, i.e. the header
+        if ( header_marker == 0 ):
+            header_marker += 1
+
+            # work out where the taxonomy ends once and split all rows the same way
+            split_row = make_row_splitter( level_count or detect_level_count( line.rstrip().split("\t") ) )
+
+            yield "#taxa\t" + split_row( line )[1] + "\ttaxonomy"
+
+            # go to next iteration of for loop once finished with header
+            continue
+
+        taxonomy, values = split_row( line )
+
+        tax = ";".join( taxonomy )
+
+        if id_mode == "hash":
+            taxa_id = hash_taxonomy( tax )
+        else:
+            taxa_id = str(taxa_num)
 
-    outfile = open( args.output , "w" )
+        yield taxa_id + "\t" + values + "\t" + tax
 
-    with open( args.input , "r" ) as infile:
+        # add 1 to the taxa id
+        taxa_num += 1
 
-        for line in infile:
+def open_output( output_file , compress=False ):
+    '''Open output text file for writing, with gzip compression if compress is set'''
 
-            # remove newline character
-            line = line.rstrip()
+    if compress:
+        return gzip.open( output_file , "wt" )
+    else:
+        return open( output_file , "w" )
 
-            # split by tab
-            line_split = line.split("\t") 
+def write_blocks( outfile , lines ):
+    '''Write lines (without newline characters) to outfile, joining up to BLOCK_LINES lines at a time into a single write'''
 
-            # if this integer == 0 then that means it's the first line, i.e. the header
-            if ( header_marker == 0 ):
-                header_marker += 1
+    block = []
 
-                header = ["#taxa"] + line_split[8:] + ["taxonomy"]
+    for line in lines:
 
-                # convert each element of header to a string
-                headerline = [str(e) for e in header]
-                col = "\t".join( headerline )
-                print( col , file=outfile )
+        block.append( line )
 
-                # go to next iteration of for loop once finished with header
-                continue
+        if len(block) == BLOCK_LINES:
+            outfile.write( "\n".join( block ) + "\n" )
+            block = []
+
+    if block:
+        outfile.write( "\n".join( block ) + "\n" )
+
+def write_hdf5_biom( output_file , sample_ids , taxonomies , abundances , id_mode="number" ):
+    '''Write compressed HDF5 BIOM (v2.1) file with taxa ids assigned according to id_mode (see taxa_ids) and the taxonomy of each taxa as observation metadata'''
+
+    # only needed for HDF5 output
+    from biom import Table
+    import h5py
+
+    table = Table( abundances , taxa_ids( taxonomies , id_mode ) , sample_ids ,
+                   observation_metadata=[ { "taxonomy" : tax } for tax in taxonomies ] ,
+                   type="Taxon table" )
+
+    with h5py.File( output_file , "w" ) as outfile:
+        table.to_hdf5( outfile , "metaphlan2_stamp_to_biom.py" , compress=True )
+
+def main():
+
+    args = parser.parse_args()
 
-            tax = ";".join( line_split[0:8] )
+    if args.gzip and args.hdf5:
+        parser.error( "--gzip only applies to legacy TSV BIOM output (HDF5 BIOM output is always compressed)" )
 
-            row_list = [ taxa_num ] + line_split[8:] + [tax]
+    if args.hdf5 or len(args.input) > 1:
 
-            # convert each element of row_list to string
-            row = [str(e) for e in row_list]
+        sample_ids, taxonomies, abundances = read_stamp_tables( args.input , args.level_count )
 
-            line_out = "\t".join( row )
+        if args.hdf5:
+            write_hdf5_biom( args.output , sample_ids , taxonomies , abundances , args.id_mode )
+            return
 
-            print( line_out , file=outfile)
+        with open_output( args.output , args.gzip ) as outfile:
+            write_blocks( outfile , tsv_biom_lines( sample_ids , taxonomies , abundances , args.id_mode ) )
 
-            # add 1 to the taxa id
-            taxa_num += 1 
+        return
 
-    outfile.close()
+    with open( args.input[0] , "r" ) as infile, open_output( args.output , args.gzip ) as outfile:
+        write_blocks( outfile , stamp_to_tsv_biom_lines( infile , args.level_count , args.id_mode ) )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import fix_spf
+
+
+def write_spf(path, rows):
+    with open(path, "w") as spf:
+        spf.write("L1\tL2\tL3\tS1\n")
+        for row in rows:
+            spf.write("\t".join(row) + "\n")
+
+
+def read_labels(path):
+    with open(path) as spf:
+        next(spf)
+        return [line.split("\t")[0:3] for line in spf]
+
+
+def run_batch(tmp_path, name, rows, state):
+    in_spf = str(tmp_path / (name + ".spf"))
+    out_spf = str(tmp_path / (name + "_fixed.spf"))
+    write_spf(in_spf, rows)
+    fix_spf.fix_spf_file(in_spf, out_spf, 3, state=state)
+    return read_labels(out_spf)
+
+
+def test_state_keeps_suffixes_when_earlier_batch_is_rerun(tmp_path):
+    batch1 = [["A", "B", "C", "1"], ["A", "B2", "C", "2"]]
+    batch2 = [["A2", "B", "C", "3"]]
+    state_file = str(tmp_path / "state.tsv")
+
+    state = {}
+    run_batch(tmp_path, "batch1", batch1, state)
+    fix_spf.write_hierarchy_state(state_file, state)
+
+    state = fix_spf.read_hierarchy_state(state_file)
+    run_batch(tmp_path, "batch2", batch2, state)
+    fix_spf.write_hierarchy_state(state_file, state)
+
+    state = fix_spf.read_hierarchy_state(state_file)
+    rerun = run_batch(tmp_path, "batch1_rerun", batch1, state)
+
+    # Same labels as fixing both batches in a single run.
+    combined = run_batch(tmp_path, "combined", batch1 + batch2, None)
+
+    assert rerun == combined[0:2]
+    assert rerun == [["A", "B_dup0", "C_dup0"], ["A", "B2", "C_dup1"]]
+
+    with open(state_file) as state_in:
+        assert len(state_in.readlines()) == 7
+
+
+def fix_lines(tmp_path, lines, col_count, **kwargs):
+    in_spf = str(tmp_path / "in.spf")
+    out_spf = str(tmp_path / "out.spf")
+    with open(in_spf, "w") as spf:
+        spf.write("".join(line + "\n" for line in lines))
+    fix_spf.fix_spf_file(in_spf, out_spf, col_count, **kwargs)
+    with open(out_spf) as spf:
+        return spf.read().splitlines()
+
+
+def test_intermediate_unclassified_is_filled_in(tmp_path):
+    lines = ["L1\tL2\tL3\tL4\tS1", "B\tUnclassified\tG\tI\t4"]
+
+    assert fix_lines(tmp_path, lines, 4, stream=True) == \
+        ["L1\tL2\tL3\tL4\tS1", "B\tB_X\tG\tI\t4"]
+
+    assert fix_lines(tmp_path, lines, 4, replace_ambig=True) == \
+        ["L1\tL2\tL3\tL4\tS1", "B\tB_X\tG\tI\t4"]
+
+
+def test_replace_ambig_fills_in_created_unclassified(tmp_path):
+    lines = ["L1\tL2\tL3\tL4\tS1",
+             "D_0__Bacteria\tD_1__uncultured\tD_2__C2\tD_3__O\t4"]
+    expected = ["L1\tL2\tL3\tL4\tS1",
+                "D_0__Bacteria\tD_0__Bacteria_X\tD_2__C2\tD_3__O\t4"]
+
+    for passthrough_counts in [False, True]:
+        assert fix_lines(tmp_path, lines, 4, replace_ambig=True,
+                         passthrough_counts=passthrough_counts) == expected
+
+
+def test_blank_lines_are_skipped(tmp_path):
+    lines = ["L1\tL2\tS1", "A\tB\t1", "", "A\tC\t2", ""]
+    expected = ["L1\tL2\tS1", "A\tB\t1", "A\tC\t2"]
+
+    assert fix_lines(tmp_path, lines, 2) == expected
+    assert fix_lines(tmp_path, lines, 2, passthrough_counts=True) == expected
+
+
+def test_blank_lines_are_skipped_when_streaming(tmp_path):
+    lines = ["L1\tL2\tS1", "A\tB\t1", "", "A\tC\t2", ""]
+    expected = ["L1\tL2\tS1", "A\tB\t1", "A\tC\t2"]
+    map_file = str(tmp_path / "map.tsv")
+
+    assert fix_lines(tmp_path, lines, 2, stream=True,
+                     write_map=map_file) == expected
+    assert fix_lines(tmp_path, lines, 2, apply_map=map_file) == expected
+
+
+def test_ambig_strings_are_matched_before_unknown_strings():
+    match_label = fix_spf.make_label_matcher(['own_b'], ['unknown'])
+
+    assert match_label('d_2__unknown_bac') == "ambig"
+    assert match_label('d_2__unknown') == "unknown"
+    assert match_label('d_2__known') is None